@@ -2,6 +2,7 @@ import datetime
 import json
 import re
 import subprocess
+import time
 from datetime import datetime
 import requests
 from cachetools import TTLCache, cached
@@ -109,14 +110,14 @@ def check_pending_positions(traders, logger):
                         response = json.loads(decoded_string)
                         if "symbol" in response and response["symbol"] == trader.stock:
                             if "order_id" in response and response["order_id"] > str(
-                                    trader.last_updated.timestamp() - CONFIG["MAX_ORDER_TIME_OFFSET"]):
+                                    trader.last_updated - CONFIG["MAX_ORDER_TIME_OFFSET"]):
                                 if response["status"] == "CANCELLED":
                                     last_trade = get_last_trade(trader.stock)
                                     trader.volume -= last_trade[4]
                                     trader.total_cost -= last_trade[5]
                                     trader.position_status = PositionStatus.TRADABLE.name
                                     trader.buy_count -= 1
-                                    trader.last_updated = datetime.now()
+                                    trader.last_updated = time.time()
                                     update_position(trader)
                                     delete_trade(last_trade[0])
                                     last_trade = get_last_trade(trader.stock)
@@ -125,9 +126,13 @@ def check_pending_positions(traders, logger):
                                         trader.avg_price = 0
                                         trader.volume = 0
                                         trader.total_cost = 0
+                                        trader.last_trade_xch = 0
+                                        trader.last_trade_volume = 0
                                     else:
                                         trader.avg_price = trader.total_cost / trader.volume
                                         trader.last_buy_price = last_trade[3]
+                                        trader.last_trade_xch = last_trade[5]
+                                        trader.last_trade_volume = last_trade[4]
                                     update_position(trader)
                                     confirmed = True
                                     logger.info(f"Buy {trader.stock} cancelled")
@@ -155,10 +160,10 @@ def check_pending_positions(traders, logger):
                         response = json.loads(decoded_string)
                         if "symbol" in response and response["symbol"] == trader.stock:
                             if "order_id" in response and response["order_id"] > str(
-                                    trader.last_updated.timestamp() - CONFIG["MAX_ORDER_TIME_OFFSET"]):
+                                    trader.last_updated - CONFIG["MAX_ORDER_TIME_OFFSET"]):
                                 if response["status"] == "CANCELLED":
                                     trader.position_status = PositionStatus.TRADABLE.name
-                                    trader.last_updated = datetime.now()
+                                    trader.last_updated = time.time()
                                     update_position(trader)
                                     last_trade = get_last_trade(trader.stock)
                                     delete_trade(last_trade[0])
@@ -186,9 +191,9 @@ def check_pending_positions(traders, logger):
                         logger.debug(f"Found coin with memo for {trader.stock}, memo: {decoded_string}")
                         if "symbol" in response and response["symbol"] == trader.stock:
                             logger.debug(
-                                f"Last Update {str(trader.last_updated.timestamp())}, Order: {response['order_id']}")
+                                f"Last Update {str(trader.last_updated)}, Order: {response['order_id']}")
                             if "order_id" in response and response["order_id"] > str(
-                                    trader.last_updated.timestamp() - CONFIG["MAX_ORDER_TIME_OFFSET"]):
+                                    trader.last_updated - CONFIG["MAX_ORDER_TIME_OFFSET"]):
                                 if response["status"] == "COMPLETED":
                                     if trader.position_status == PositionStatus.PENDING_SELL.name:
                                         # The order is created after the last update
@@ -200,7 +205,7 @@ def check_pending_positions(traders, logger):
                                         trader.avg_price = 0
                                         trader.current_price = 0
                                         trader.profit = 0
-                                        trader.last_updated = datetime.now()
+                                        trader.last_updated = time.time()
                                         update_position(trader)
                                         logger.info(f"Sell {trader.stock} confirmed")
                                         break
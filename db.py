@@ -1,25 +1,76 @@
-from datetime import datetime
+import atexit
+import logging
+import queue
 import sqlite3
+import threading
+import time
 
 from constant import PositionStatus
 
-# Connect to SQLite database
-conn = sqlite3.connect('trading_history.db')
-cursor = conn.cursor()
+# SQL used on every trading round, kept as constants so sqlite3 always finds them in its statement cache
+_UPDATE_SQL = '''INSERT OR REPLACE INTO positions (stock_id, buy_count, last_buy_price, volume, total_cost, avg_price, current_price, profit, status, last_updated, last_trade_xch, last_trade_volume)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+_SELECT_SQL = '''SELECT volume,buy_count, last_buy_price, total_cost, avg_price, current_price, profit, status, last_updated, last_trade_xch, last_trade_volume FROM positions WHERE stock_id = ?'''
+_INSERT_POS_SQL = '''INSERT INTO positions (stock_id, buy_count, last_buy_price, volume, total_cost, avg_price, current_price, profit, status, last_updated, last_trade_xch, last_trade_volume)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+_INSERT_TRADE_SQL = '''INSERT INTO trades (stock_id, action, price, volume, crypto_cost, profit)
+                       VALUES (?, ?, ?, ?, ?, ?)'''
+_LAST_TRADE_SQL = '''SELECT id, stock_id, action, price, volume, crypto_cost, profit FROM trades WHERE stock_id = ? ORDER BY timestamp DESC LIMIT 1'''
+_LAST_BUY_SQL = '''SELECT id, stock_id, action, price, volume, crypto_cost, profit FROM trades WHERE stock_id = ? AND action = 'BUY' ORDER BY timestamp DESC, id DESC LIMIT 1'''
+_DELETE_TRADE_SQL = '''DELETE FROM trades WHERE id = ?'''
 
-# Create a table to store trade history
-cursor.execute('''CREATE TABLE IF NOT EXISTS trades (
+# The writer thread commits whatever is queued every 100ms, or as soon as 128 writes are waiting
+_WRITE_BATCH_INTERVAL = 0.1
+_WRITE_BATCH_SIZE = 128
+# A batch that finds the database locked is retried with exponential backoff, starting at 50ms
+_WRITE_RETRIES = 5
+_WRITE_RETRY_DELAY = 0.05
+# A batch that is still locked after the backoff is kept and retried after this many seconds, it is never dropped
+_WRITE_FAILURE_DELAY = 1
+
+logger = logging.getLogger("Rotating Log")
+
+
+def _connect():
+    # Autocommit mode, transactions are opened explicitly instead of by the driver before the first write
+    connection = sqlite3.connect('trading_history.db', cached_statements=256, isolation_level=None)
+    # WAL lets readers run alongside the writer and, with synchronous=NORMAL, only fsyncs on checkpoint
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA temp_store=MEMORY")
+    connection.execute("PRAGMA cache_size=-20000")
+    connection.execute("PRAGMA mmap_size=268435456")
+    # Let ANALYZE sample about 400 rows per index instead of reading whole tables
+    connection.execute("PRAGMA analysis_limit=400")
+    return connection
+
+
+_local = threading.local()
+
+
+def _get_conn():
+    # sqlite3 connections must not be shared between threads, so every thread lazily opens its own
+    connection = getattr(_local, "conn", None)
+    if connection is None:
+        connection = _local.conn = _connect()
+    return connection
+
+
+# Connect to SQLite database, this thread's connection is used for reads only once the writer thread runs
+conn = _get_conn()
+
+_CREATE_TRADES_SQL = '''CREATE TABLE IF NOT EXISTS trades (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    stock TEXT,
+                    stock_id INTEGER REFERENCES symbols(id),
                     action TEXT,
                     price REAL,
                     volume INTEGER,
                     crypto_cost REAL,
                     profit REAL,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)'''
 
-cursor.execute('''CREATE TABLE IF NOT EXISTS positions (
-                    stock TEXT PRIMARY KEY,
+_CREATE_POSITIONS_SQL = '''CREATE TABLE IF NOT EXISTS positions (
+                    stock_id INTEGER PRIMARY KEY REFERENCES symbols(id),
                     volume REAL,
                     buy_count INTEGER,
                     last_buy_price REAL,
@@ -28,51 +79,208 @@ cursor.execute('''CREATE TABLE IF NOT EXISTS positions (
                     current_price REAL,
                     profit REAL,
                     status TEXT,
-                    last_updated DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+                    last_updated INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+                    last_trade_xch REAL,
+                    last_trade_volume REAL)'''
+
+# Stock symbols are interned here, positions and trades refer to them by an INTEGER PRIMARY KEY
+conn.execute('''CREATE TABLE IF NOT EXISTS symbols (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT UNIQUE)''')
+# Create a table to store trade history
+conn.execute(_CREATE_TRADES_SQL)
+conn.execute(_CREATE_POSITIONS_SQL)
+# Databases created before the last trade was cached on the trader lack these columns
+_position_columns = {row[1] for row in conn.execute("PRAGMA table_info(positions)")}
+for _column in ("last_trade_xch", "last_trade_volume"):
+    if _column not in _position_columns:
+        conn.execute(f"ALTER TABLE positions ADD COLUMN {_column} REAL")
+# last_updated used to be stored as local time text, convert it to Unix epoch seconds
+conn.execute('''UPDATE positions SET last_updated = CAST(strftime('%s', last_updated, 'utc') AS INTEGER)
+                  WHERE typeof(last_updated) = 'text' ''')
+# Databases created before symbols were interned key both tables by the symbol text, rebuild them in one transaction
+if "stock" in _position_columns:
+    conn.executescript(f'''BEGIN;
+        ALTER TABLE positions RENAME TO positions_legacy;
+        ALTER TABLE trades RENAME TO trades_legacy;
+        {_CREATE_TRADES_SQL};
+        {_CREATE_POSITIONS_SQL};
+        INSERT OR IGNORE INTO symbols (name) SELECT stock FROM positions_legacy UNION SELECT stock FROM trades_legacy;
+        INSERT INTO trades (id, stock_id, action, price, volume, crypto_cost, profit, timestamp)
+            SELECT t.id, s.id, t.action, t.price, t.volume, t.crypto_cost, t.profit, t.timestamp
+            FROM trades_legacy t JOIN symbols s ON s.name = t.stock;
+        INSERT INTO positions (stock_id, volume, buy_count, last_buy_price, total_cost, avg_price, current_price, profit, status, last_updated, last_trade_xch, last_trade_volume)
+            SELECT s.id, p.volume, p.buy_count, p.last_buy_price, p.total_cost, p.avg_price, p.current_price, p.profit, p.status, p.last_updated, p.last_trade_xch, p.last_trade_volume
+            FROM positions_legacy p JOIN symbols s ON s.name = p.stock;
+        DROP TABLE positions_legacy;
+        DROP TABLE trades_legacy;
+        COMMIT;''')
+# get_last_trade seeks the newest trade of a stock through this index instead of scanning the whole table
+conn.execute("CREATE INDEX IF NOT EXISTS idx_trades_stock_ts ON trades(stock_id, timestamp DESC)")
+# Gather planner statistics on first start. PRAGMA optimize is not used, before SQLite 3.46 it only analyzes tables
+# the same connection has already queried, and this one has only run DDL
+if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone() is None:
+    conn.execute("ANALYZE")
+
+# Symbol name -> id in the symbols table, filled at start-up and extended when a new symbol is traded
+_symbol_id = {name: symbol_id for symbol_id, name in conn.execute("SELECT id, name FROM symbols")}
+
+
+def _get_symbol_id(stock):
+    if stock not in _symbol_id:
+        # A new symbol must exist before the writer thread stores rows referring to it
+        connection = _get_conn()
+        connection.execute("INSERT OR IGNORE INTO symbols (name) VALUES (?)", (stock,))
+        _symbol_id[stock] = connection.execute("SELECT id FROM symbols WHERE name = ?", (stock,)).fetchone()[0]
+    return _symbol_id[stock]
+
+
+def _coalesce(batch):
+    # Merge runs of the same statement, so e.g. all trades recorded in one round go through a single executemany
+    merged = []
+    for sql, rows in batch:
+        if merged and merged[-1][0] == sql:
+            merged[-1][1].extend(rows)
+        else:
+            merged.append((sql, list(rows)))
+    return merged
+
 
-conn.commit()
+def _is_busy(error):
+    # Only a locked or busy database is worth retrying, any other error will fail the same way again
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
 
 
+def _commit_batch(writer_conn, batch):
+    # BEGIN IMMEDIATE takes the write lock up front, so a busy database is reported here and not halfway through
+    delay = _WRITE_RETRY_DELAY
+    for attempt in range(_WRITE_RETRIES):
+        try:
+            writer_conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, rows in _coalesce(batch):
+                    writer_conn.executemany(sql, rows)
+                writer_conn.execute("COMMIT")
+            except BaseException:
+                if writer_conn.in_transaction:
+                    writer_conn.execute("ROLLBACK")
+                raise
+            return
+        except sqlite3.OperationalError as e:
+            if not _is_busy(e) or attempt == _WRITE_RETRIES - 1:
+                raise
+            logger.warning(f"Database is busy, retrying the write in {delay}s: {e}")
+            time.sleep(delay)
+            delay *= 2
+
+
+def _write_loop():
+    global _write_error
+    writer_conn = _get_conn()
+    batch = []
+    while True:
+        if not batch:
+            batch.append(_writer_queue.get())
+        deadline = time.monotonic() + _WRITE_BATCH_INTERVAL
+        while len(batch) < _WRITE_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(_writer_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        try:
+            _commit_batch(writer_conn, batch)
+        except Exception as e:
+            # Never drop the batch, the database would drift from the traders in memory. flush() reports the error
+            _write_error = e
+            if not _is_busy(e):
+                logger.error(f"Failed to write {len(batch)} queued statements to the database, stopping the writer: {e}")
+                return
+            logger.error(f"Database still locked, retrying {len(batch)} queued statements: {e}")
+            time.sleep(_WRITE_FAILURE_DELAY)
+            continue
+        _write_error = None
+        for _ in batch:
+            _writer_queue.task_done()
+        batch = []
+
+
+# Writes are queued as (sql, rows) and committed by a background thread, so trading never waits on disk
+_writer_queue = queue.Queue()
+# Last error of the writer thread, set while a batch keeps failing and cleared once it is committed
+_write_error = None
+_writer_thread = threading.Thread(target=_write_loop, name="db-writer", daemon=True)
+_writer_thread.start()
+
+
+def flush():
+    # Block until every queued write has been committed, raise instead of waiting forever if the writer cannot commit
+    with _writer_queue.all_tasks_done:
+        while _writer_queue.unfinished_tasks:
+            if _write_error is not None:
+                raise Exception(f"Failed to commit queued database writes: {_write_error}") from _write_error
+            if not _writer_thread.is_alive():
+                raise Exception("Database writer thread is not running, queued writes cannot be committed")
+            _writer_queue.all_tasks_done.wait(_WRITE_BATCH_INTERVAL)
+
+
+# The writer is a daemon thread, commit whatever is still queued when the process exits, also on errors and Ctrl-C
+atexit.register(flush)
+
+
+def _position_row(trader):
+    return (_get_symbol_id(trader.stock), trader.buy_count, trader.last_buy_price, trader.volume, trader.total_cost,
+            trader.avg_price, trader.current_price, trader.profit, trader.position_status,
+            int(trader.last_updated), trader.last_trade_xch, trader.last_trade_volume)
+
+
+# The write helpers below only queue their statement, the writer thread commits it shortly after
 def update_position(self):
     # Update the current price, profit, and last updated time in the positions table
-    cursor.execute('''INSERT OR REPLACE INTO positions (stock, buy_count, last_buy_price, volume, total_cost, avg_price, current_price, profit, status, last_updated)
-                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                   (self.stock, self.buy_count, self.last_buy_price, self.volume, self.total_cost, self.avg_price,
-                    self.current_price, self.profit, self.position_status, self.last_updated))
-    conn.commit()
+    _writer_queue.put((_UPDATE_SQL, [_position_row(self)]))
+
 
+def update_positions_bulk(traders):
+    # Same as update_position, but binds all rows to one prepared statement
+    _writer_queue.put((_UPDATE_SQL, [_position_row(t) for t in traders]))
 
+
+# The read helpers flush first, so they always see the writes this process has queued
 def get_position(stock):
-    cursor.execute(
-        '''SELECT volume,buy_count, last_buy_price, total_cost, avg_price, current_price, profit, status, last_updated FROM positions WHERE stock = ?''',
-        (stock,))
-    result = cursor.fetchone()
-    return result
+    flush()
+    return _get_conn().execute(_SELECT_SQL, (_get_symbol_id(stock),)).fetchone()
 
 
 def create_position(self):
     # Insert new stock
-    cursor.execute('''INSERT INTO positions (stock, buy_count, last_buy_price, volume, total_cost, avg_price, current_price, profit, status, last_updated)
-                              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                   (self.stock, self.buy_count, self.last_buy_price, self.volume, self.total_cost, self.avg_price,
-                    self.current_price, self.profit, self.position_status, self.last_updated))
-    conn.commit()
+    _writer_queue.put((_INSERT_POS_SQL, [_position_row(self)]))
 
 
 def record_trade(stock, action, price, volume, crypto_cost, profit):
-    cursor.execute('''INSERT INTO trades (stock, action, price, volume, crypto_cost, profit) 
-                          VALUES (?, ?, ?, ?, ?, ?)''',
-                   (stock, action, price, volume, crypto_cost, profit))
-    conn.commit()
+    _writer_queue.put((_INSERT_TRADE_SQL, [(_get_symbol_id(stock), action, price, volume, crypto_cost, profit)]))
 
 def get_last_trade(stock):
     # Return the recent trade for the stock
-    cursor.execute('''SELECT id, stock, action, price, volume, crypto_cost, profit FROM trades WHERE stock = ? ORDER BY timestamp DESC LIMIT 1''',
-                   (stock,))
-    result = cursor.fetchone()
-    return result
+    flush()
+    return _get_conn().execute(_LAST_TRADE_SQL, (_get_symbol_id(stock),)).fetchone()
+
+def get_last_buy(stock):
+    # Return the recent BUY trade for the stock, skipping any sell recorded after it
+    flush()
+    return _get_conn().execute(_LAST_BUY_SQL, (_get_symbol_id(stock),)).fetchone()
 
 def delete_trade(trade_id):
-    cursor.execute('''DELETE FROM trades WHERE id = ?''',
-                   (trade_id,))
-    conn.commit()
\ No newline at end of file
+    _writer_queue.put((_DELETE_TRADE_SQL, [(trade_id,)]))
+
+
+def checkpoint_wal():
+    # Fold the WAL back into the database file so the -wal file does not grow unbounded
+    _get_conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def optimize():
+    # Keep query plans on the index as the trades table grows, a bounded ANALYZE since analysis_limit is set
+    _get_conn().execute("ANALYZE")
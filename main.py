@@ -11,7 +11,8 @@ import requests
 
 from chia import get_xch_price, sign_message
 from constant import CONFIG
-from db import update_position
+from db import flush, update_position
+from stock import get_stock_price_from_dinari
 from stock_trader import execute_trading, StockTrader
 
 logger = logging.getLogger("Rotating Log")
@@ -38,6 +39,8 @@ def load_config(wallet: int, did: str):
     if response.status_code == 200:
         dca = json.loads(response.json()["trading_strategy"])["DCA"]
         CONFIG.update(dca)
+        # Membership is tested on every buy, so build the set once here
+        CONFIG["SELL_ONLY_SYMBOLS"] = frozenset(CONFIG.get("SELL_ONLY_SYMBOLS", ()))
         logger.info(f"Loaded user trading strategy: {CONFIG}")
     else:
         logger.error(f"Failed to get user trading strategy: {response.text}")
@@ -91,8 +94,11 @@ def liquidate(wallet: int, did: str, ticker: str):
     stock = StockTrader(ticker, logger)
     if stock.volume >= 0:
         xch_price = get_xch_price(logger)
-        stock.sell_stock(xch_price, True)
+        price = float(get_stock_price_from_dinari(stock.stock, logger)[0])
+        stock.sell_stock(xch_price, price, True)
         update_position(stock)
+        # The writer thread is a daemon, make sure the liquidation is on disk before exiting
+        flush()
         print(
             f"Successfully liquidated the stock {stock.stock},  volume {stock.volume}, price {stock.current_price}, total profit {stock.profit}")
 
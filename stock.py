@@ -1,10 +1,12 @@
 from datetime import datetime
+from threading import Lock
 
 import requests
 from cachetools import TTLCache, cached
 
-cache = TTLCache(maxsize=100, ttl=60)
-clock = TTLCache(maxsize=1, ttl=60)
+# Trading rounds start 60s apart, keep entries for less than that so every round fetches a fresh quote and market status
+cache = TTLCache(maxsize=100, ttl=30)
+clock = TTLCache(maxsize=1, ttl=30)
 
 
 def fetch_token_infos():
@@ -48,7 +50,8 @@ def get_stock_id_by_symbol(symbol):
     raise ValueError("Stock symbol not found.")
 
 
-@cached(cache)
+# Prices are fetched from a thread pool, so guard the shared cache
+@cached(cache, lock=Lock())
 def get_stock_price_from_dinari(symbol, logger):
     try:
         stock_id = get_stock_id_by_symbol(symbol)
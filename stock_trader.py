@@ -1,13 +1,20 @@
+import logging
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from chia import get_xch_price, send_asset, get_xch_balance, add_token, check_pending_positions
 from constant import PositionStatus, CONFIG
 
-from db import cursor, conn, get_position, update_position, create_position, record_trade, get_last_trade
+from db import get_position, update_positions_bulk, create_position, record_trade, get_last_buy, checkpoint_wal, \
+    optimize, flush
 from pools import STOCKS
 from stock import is_market_open, get_stock_price_from_dinari
 
+# Position status names, resolved once instead of going through the Enum on every check
+_TRADABLE = PositionStatus.TRADABLE.name
+_PENDING_BUY = PositionStatus.PENDING_BUY.name
+_PENDING_SELL = PositionStatus.PENDING_SELL.name
+
 
 class StockTrader:
     def __init__(self, stock, logger):
@@ -20,8 +27,12 @@ class StockTrader:
         self.avg_price = 0
         self.current_price = 0
         self.profit = 0
-        self.position_status = PositionStatus.TRADABLE.name
-        self.last_updated = datetime.now()
+        self.position_status = _TRADABLE
+        # Unix epoch seconds of the last order, compared against order ids when checking pending positions
+        self.last_updated = time.time()
+        # XCH paid and shares received by the most recent buy, used to detect price drops without a DB query
+        self.last_trade_xch = 0
+        self.last_trade_volume = 0
         self.load_position()
         # Check if stock token is added to Chia wallet
         self.wallet_id = add_token(self.stock)
@@ -32,22 +43,29 @@ class StockTrader:
         result = get_position(self.stock)
         self.logger.info(f"Loaded position for {self.stock}: {result}")
         if result:
-            date_format = "%Y-%m-%d %H:%M:%S"
-            self.volume, self.buy_count, self.last_buy_price, self.total_cost, self.avg_price, self.current_price, self.profit, self.position_status, self.last_updated = result
-            self.last_updated = datetime.strptime(self.last_updated.split(".")[0], date_format)
+            self.volume, self.buy_count, self.last_buy_price, self.total_cost, self.avg_price, self.current_price, self.profit, self.position_status, self.last_updated, self.last_trade_xch, self.last_trade_volume = result
+            if self.last_trade_volume is None:
+                # Position saved before the last buy was cached, seed it from the trade history once. A pending
+                # sell is recorded after the buy and holds the average cost, so only look at BUY trades
+                last_buy = get_last_buy(self.stock)
+                self.last_trade_xch, self.last_trade_volume = (last_buy[5], last_buy[4]) if last_buy else (0, 0)
         else:
             create_position(self)
 
-    def buy_stock(self, xch_volume, xch_price):
-        if self.stock in set(CONFIG["SELL_ONLY_SYMBOLS"]):
+    def _recompute_profit(self, xch_price):
+        # One division instead of two: volume * price / xch_price / total_cost
+        self.profit = (self.volume * self.current_price) / (xch_price * self.total_cost) - 1 if self.total_cost else 0
+
+    def buy_stock(self, xch_volume, xch_price, price, timestamp=None):
+        if self.stock in CONFIG["SELL_ONLY_SYMBOLS"]:
             self.logger.info(f"{self.stock} is in SELL_ONLY_SYMBOLS, skipping...")
             return
-        price = float(get_stock_price_from_dinari(self.stock, self.logger)[1])
         if price == 0:
             self.logger.error(f"Failed to get stock price for {self.stock}, skipping...")
             return
         volume = xch_volume * xch_price / price
-        timestamp = datetime.now()
+        if timestamp is None:
+            timestamp = time.time()
         if not send_asset(STOCKS[self.stock]["buy_addr"], 1, volume, xch_volume, self.logger):
             # Failed to send order
             return
@@ -56,22 +74,25 @@ class StockTrader:
         self.total_cost += xch_volume
         self.avg_price = self.total_cost / self.volume
         self.current_price = price
-        self.profit = self.volume * self.current_price / xch_price / self.total_cost - 1
-        self.position_status = PositionStatus.PENDING_BUY.name
+        self._recompute_profit(xch_price)
+        self.position_status = _PENDING_BUY
         self.buy_count += 1
         self.last_updated = timestamp
+        self.last_trade_xch = xch_volume
+        self.last_trade_volume = volume
         record_trade(self.stock, "BUY", price, volume, xch_volume, 0)
         self.logger.info(f"Bought {volume} shares of {self.stock} at ${price}")
 
-    def sell_stock(self, xch_price, liquid=False):
-        self.current_price = float(get_stock_price_from_dinari(self.stock, self.logger)[0])
+    def sell_stock(self, xch_price, price, liquid=False, timestamp=None):
+        self.current_price = price
         if self.current_price == 0:
             self.logger.error(f"Failed to get stock price for {self.stock}, skipping...")
             return
         request_xch = self.volume * self.current_price / xch_price
-        self.profit = request_xch / self.total_cost - 1
+        self._recompute_profit(xch_price)
         if self.profit >= CONFIG["MIN_PROFIT"] or liquid:
-            timestamp = datetime.now()
+            if timestamp is None:
+                timestamp = time.time()
             if not send_asset(STOCKS[self.stock]["sell_addr"], self.wallet_id, request_xch,
                               self.volume, self.logger):
                 # Failed to send order
@@ -79,23 +100,23 @@ class StockTrader:
             record_trade(self.stock, "SELL", self.current_price, self.volume, self.total_cost, self.profit)
             self.logger.info(
                 f"Sold {self.volume} shares of {self.stock} at ${self.current_price} with {self.profit * 100:.2f}% profit")
-            self.position_status = PositionStatus.PENDING_SELL.name
+            self.position_status = _PENDING_SELL
             self.last_updated = timestamp
 
-    def handle_price_drop(self, xch_price):
-        self.current_price = float(get_stock_price_from_dinari(self.stock, self.logger)[1])
+    def handle_price_drop(self, xch_price, price, timestamp=None):
+        self.current_price = price
         if self.current_price == 0:
             self.logger.error(f"Failed to get stock price for {self.stock}, skipping...")
             return
-        self.profit = self.volume * self.current_price / xch_price / self.total_cost - 1
-        last_trade = get_last_trade(self.stock)
-        last_price = last_trade[5] / last_trade[4]
+        self._recompute_profit(xch_price)
+        last_price = self.last_trade_xch / self.last_trade_volume
         drop_percentage = (last_price - self.current_price / xch_price) / last_price
         self.logger.debug(
             f"Previous price: {last_price}, Current price: {xch_price / self.current_price}, Drop percentage: {drop_percentage * 100:.2f}%")
         if self.buy_count == CONFIG["MAX_BUY_TIMES"] and self.profit < -CONFIG["MAX_LOSS_PERCENTAGE"]:
             request_xch = self.volume * self.current_price / xch_price
-            timestamp = datetime.now()
+            if timestamp is None:
+                timestamp = time.time()
             if not send_asset(STOCKS[self.stock]["sell_addr"], self.wallet_id, request_xch,
                               self.volume, self.logger):
                 # Failed to send order
@@ -103,57 +124,90 @@ class StockTrader:
             record_trade(self.stock, "SELL", self.current_price, self.volume, self.total_cost, self.profit)
             self.logger.info(
                 f"Sold {self.volume} shares of {self.stock} at ${self.current_price} with {self.profit * 100:.2f}% profit, since the loss exceeded the maximum loss percentage")
-            self.position_status = PositionStatus.PENDING_SELL.name
+            self.position_status = _PENDING_SELL
             self.last_updated = timestamp
             return
         if drop_percentage >= CONFIG["DCA_PERCENTAGE"] and self.buy_count < CONFIG["MAX_BUY_TIMES"]:  # 5% drop
             self.logger.info(f"Price dropped by 5% for {self.stock}, repurchasing...")
-            self.buy_stock(CONFIG["BUY_PERCENTAGE"] * CONFIG["INVESTED_XCH"], xch_price)  # Repurchase the same volume
+            self.buy_stock(CONFIG["BUY_PERCENTAGE"] * CONFIG["INVESTED_XCH"], xch_price, price,
+                           timestamp=timestamp)  # Repurchase the same volume
 
 
 def execute_trading(logger):
     # Current market status
     traders = [StockTrader(stock, logger) for stock in CONFIG["TRADING_SYMBOLS"]]
+    # Stock prices are independent HTTP calls, fetch them concurrently instead of one trader after another
+    pool = ThreadPoolExecutor(max_workers=max(1, min(32, len(traders))))
+    # Rounds are scheduled against a monotonic deadline, so the time spent in a round does not delay the next one
+    next_tick = time.monotonic()
+    last_optimize = next_tick
 
     while True:
         xch_price = get_xch_price(logger)
         if xch_price is None:
             logger.error("Failed to get XCH price, skipping...")
             time.sleep(300)
+            next_tick = time.monotonic()
             continue
+        # One timestamp for every order placed in this round
+        loop_ts = time.time()
+        # Inputs shared by every trader are evaluated once per round rather than once per trader
+        market_open = is_market_open(logger)
+        buy_xch = CONFIG["BUY_PERCENTAGE"] * CONFIG["INVESTED_XCH"]
+        futures = {trader: pool.submit(get_stock_price_from_dinari, trader.stock, logger) for trader in traders}
         stock_balance = 0
+        updated_traders = []
         for trader in traders:
-            if trader.position_status == PositionStatus.TRADABLE.name and is_market_open(logger):
+            bid_price, ask_price = futures[trader].result()
+            bid_price, ask_price = float(bid_price), float(ask_price)
+            if trader.position_status == _TRADABLE and market_open:
                 if trader.volume == 0:
-                    trader.buy_stock(CONFIG["BUY_PERCENTAGE"] * CONFIG["INVESTED_XCH"], xch_price)
+                    trader.buy_stock(buy_xch, xch_price, ask_price, timestamp=loop_ts)
                 elif trader.volume > 0:
-                    trader.sell_stock(xch_price)  # Try to sell if profit threshold is met
-                    if trader.position_status == PositionStatus.TRADABLE.name:
-                        trader.handle_price_drop(xch_price)  # Handle price drop and repurchase logic
+                    trader.sell_stock(xch_price, bid_price, timestamp=loop_ts)  # Try to sell if profit threshold is met
+                    if trader.position_status == _TRADABLE:
+                        trader.handle_price_drop(xch_price, ask_price, timestamp=loop_ts)  # Handle price drop and repurchase logic
             else:
-                trader.current_price = float(get_stock_price_from_dinari(trader.stock, logger)[1])
+                trader.current_price = ask_price
                 if trader.current_price == 0:
                     logger.info(f"Failed to get stock price for {trader.stock}, skipping...")
                     continue
-                if trader.total_cost > 0:
-                    trader.profit = trader.volume * trader.current_price / xch_price / trader.total_cost - 1
+                trader._recompute_profit(xch_price)
 
-            # log stock current price, acg price, and profit
-            logger.info(
-                f"{trader.stock}: Current Price: {trader.current_price / xch_price} XCH, Average Price: {trader.avg_price} XCH, Profit: {trader.profit * 100:.2f}%, Bought Count: {trader.buy_count}, Value: {trader.volume * trader.current_price} status: {trader.position_status}")
-            stock_balance += trader.volume * trader.current_price
-            update_position(trader)
-        # Check if the positions are still pending
-        try:
-            check_pending_positions(traders, logger)
-        except Exception as e:
-            logger.error(f"Failed to check pending positions, please check your Chia wallet: {e}")
+            cp = trader.current_price
+            value = trader.volume * cp
+            # log stock current price, acg price, and profit, f-string arguments are evaluated even when INFO is off
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    f"{trader.stock}: Current Price: {cp / xch_price} XCH, Average Price: {trader.avg_price} XCH, Profit: {trader.profit * 100:.2f}%, Bought Count: {trader.buy_count}, Value: {value} status: {trader.position_status}")
+            stock_balance += value
+            updated_traders.append(trader)
+        update_positions_bulk(updated_traders)
+        # Check if the positions are still pending, the wallet is only queried when an order is outstanding
+        pending = [t for t in traders if t.position_status in (_PENDING_BUY, _PENDING_SELL)]
+        if pending:
+            try:
+                check_pending_positions(pending, logger)
+            except Exception as e:
+                logger.error(f"Failed to check pending positions, please check your Chia wallet: {e}")
         # Get XCH balance
         xch_balance = get_xch_balance()
         total_xch = xch_balance + stock_balance / xch_price
         logger.info(
             f"Total Stock Balance: {stock_balance} USD, Total XCH Balance: {xch_balance} XCH, XCH In Total: {total_xch} XCH, profit in XCH: {(total_xch / CONFIG['INVESTED_XCH'] - 1) * 100:.2f}%, profit in USD: {(total_xch * xch_price / CONFIG['INVESTED_USD'] - 1) * 100:.2f}%")
+        # Wait for this round's trades and positions to be committed, a failing writer raises here and stops trading
+        flush()
+        if time.monotonic() - last_optimize >= 86400:
+            # Refresh the query planner statistics once a day
+            optimize()
+            last_optimize = time.monotonic()
         if is_market_open(logger):
-            time.sleep(60)  # Wait a minute before checking again
+            next_tick += 60  # Wait a minute before checking again
         else:
-            time.sleep(300)
+            # Market is closed, a good moment to truncate the WAL file
+            checkpoint_wal()
+            next_tick += 300
+        # If the round overran its deadline start the next one right away, but do not try to catch up
+        now = time.monotonic()
+        next_tick = max(next_tick, now)
+        time.sleep(next_tick - now)